@@ -1,30 +1,53 @@
-from pathlib import Path
+import os
+
+from ci_fix_core import (
+    CIFixAgent,
+    FilesystemTool,
+    GitHubTool,
+    diagnosis_from_match,
+    render_report,
+    run_local,
+    scan_diagnostics,
+)
+
 
 def read_ci_logs():
-    # In real version: GitHub MCP Server
     # Demo version: deterministic input
     return "ModuleNotFoundError: No module named 'requests'"
 
-def fix_missing_dependency(dep):
-    req = Path("requirements.txt")
-    content = req.read_text()
 
-    if dep not in content:
-        req.write_text(content + f"\n{dep}\n")
+def run_demo():
+    logs = read_ci_logs().encode("utf-8")
 
-def main():
-    logs = read_ci_logs()
+    diagnosis = diagnosis_from_match(scan_diagnostics(iter([logs])))
+    if diagnosis.get("dep"):
+        FilesystemTool().add_dependency(diagnosis["dep"])
+    print(render_report(diagnosis) or "No fixable CI hygiene issue detected")
 
-    if "ModuleNotFoundError" in logs:
-        missing = logs.split("named '")[1].split("'")[0]
-        fix_missing_dependency(missing)
 
-        print("🤖 CI Janitor Report")
-        print(f"- Error: missing dependency `{missing}`")
-        print("- Fix: added to requirements.txt")
-        print("- Action: awaiting human approval")
+def main():
+    repo = os.environ.get("GITHUB_REPOSITORY")
+    run_id = os.environ.get("RUN_ID")
+    if not run_id and not os.environ.get("PR_NUMBER"):
+        # Only without a PR context does the agent assume it is running
+        # inside the failing workflow itself; in the apply job GITHUB_RUN_ID
+        # would name the auto_fix run, whose logs hold nothing to diagnose.
+        run_id = os.environ.get("GITHUB_RUN_ID")
+    token = os.environ.get("GITHUB_TOKEN")
+
+    log_path = os.environ.get("CI_LOG_PATH")
+    if log_path:
+        # Offline mode: diagnose an already-extracted log straight from disk.
+        run_local(log_path)
+    elif repo and token and (run_id or os.environ.get("PR_NUMBER")):
+        # The apply job carries no run id; the agent recovers it from the
+        # PR's most recent failed run (GitHubTool.resolve_run_id).
+        with GitHubTool(repo, run_id, token) as github:
+            CIFixAgent(github).run()
     else:
-        print("No fixable CI hygiene issue detected")
+        # No GitHub context available: fall back to the deterministic demo.
+        run_demo()
+
 
 if __name__ == "__main__":
     main()